@@ -7,9 +7,17 @@ from a2c_ppo_acktr.distributions import Bernoulli, Categorical, DiagGaussian
 from a2c_ppo_acktr.utils import init
 from a2c_ppo_acktr.arguments import get_args
 
+@torch.compiler.disable
+def _copy_outputs(out, outputs):
+    # Kept out of torch.compile graphs: the copies would otherwise be input
+    # mutations, which stop the compiled policy from using CUDA graphs
+    torch._foreach_copy_(list(out), list(outputs))
+    return out
+
 class Flatten(nn.Module):
     def forward(self, x):
-        return x.view(x.size(0), -1)
+        # reshape, channels_last inputs cannot be viewed as (N, -1)
+        return x.reshape(x.size(0), -1)
 
 class IAMPolicy(nn.Module):
     def __init__(self, obs_shape, action_space, env, base=None, base_kwargs=None):
@@ -62,18 +70,27 @@ class IAMPolicy(nn.Module):
     def forward(self, inputs, rnn_hxs, masks):
         raise NotImplementedError
 
-    def act(self, inputs, rnn_hxs, masks, deterministic=False):
+    def act(self, inputs, rnn_hxs, masks, deterministic=False, out=None,
+            generator=None):
+        """
+        If `out` is given, it is a (value, action, action_log_probs, rnn_hxs)
+        tuple of tensors the outputs are written into and returned instead.
+        Actions are sampled with `generator` if one is given, which should
+        live on the same device as the policy.
+        """
         value, actor_features, rnn_hxs = self.base(inputs, rnn_hxs, masks)
         dist = self.dist(actor_features)
 
         if deterministic:
             action = dist.mode()
         else:
-            action = dist.sample()
+            action = dist.sample(generator=generator)
 
         action_log_probs = dist.log_probs(action)
-        dist_entropy = dist.entropy().mean()
 
+        if out is not None:
+            return _copy_outputs(
+                out, (value, action, action_log_probs, rnn_hxs))
         return value, action, action_log_probs, rnn_hxs
 
     def get_value(self, inputs, rnn_hxs, masks):
@@ -357,6 +374,8 @@ class atariBase(IAMBase):
             init_(nn.Conv2d(32, 64, 4, stride=2)), nn.ReLU(),
             init_(nn.Conv2d(64, 64, 3, stride=1)), nn.ReLU())
             # init_(nn.Linear(32 * 7 * 7, hidden_size)), nn.ReLU())
+        # NHWC convolutions are faster with cuDNN, especially in bf16
+        self.cnn.to(memory_format=torch.channels_last)
 
         self.fnn = nn.Sequential(
             Flatten(),
@@ -428,7 +447,12 @@ class atariBase(IAMBase):
         return inf_hidden   
 
     def forward(self, inputs, rnn_hxs, masks):
-        hidden_conv = self.cnn(inputs / 255.0)
+        # Observations come in as uint8, they are converted, laid out for
+        # the cnn and scaled in a single new tensor. copy=True keeps the
+        # in-place scaling off float inputs already in that layout.
+        x = inputs.to(torch.float32, memory_format=torch.channels_last,
+                      copy=True).div_(255.0)
+        hidden_conv = self.cnn(x)
 
         fnn_out = self.fnn(hidden_conv)
         inf_hidden = self.attention(hidden_conv, rnn_hxs)
@@ -22,7 +22,8 @@ class A2C_ACKTR():
                  eps=None,
                  alpha=None,
                  max_grad_norm=None,
-                 acktr=False):
+                 acktr=False,
+                 amp=False):
 
         self.actor_critic = actor_critic
         self.acktr = acktr
@@ -31,12 +32,17 @@ class A2C_ACKTR():
         self.entropy_coef = entropy_coef
 
         self.max_grad_norm = max_grad_norm
+        self.amp = amp
 
         if acktr:
             self.optimizer = KFACOptimizer(actor_critic)
         else:
+            # There is no fused RMSprop, use the multi-tensor (_foreach_*)
+            # implementation on CUDA so each step is a few kernels in total
+            # instead of a few per parameter
             self.optimizer = optim.RMSprop(
-                actor_critic.parameters(), lr, eps=eps, alpha=alpha)
+                actor_critic.parameters(), lr, eps=eps, alpha=alpha,
+                foreach=next(actor_critic.parameters()).is_cuda)
 
     def update(self, rollouts):
         obs_shape = rollouts.obs.size()[2:]
@@ -44,12 +50,17 @@ class A2C_ACKTR():
         num_steps, num_processes, _ = rollouts.rewards.size()
 
         ## deliver all past hidden state to model
-        values, action_log_probs, dist_entropy, _ = self.actor_critic.evaluate_actions(
-            rollouts.obs[:-1].view(-1, *obs_shape), 
-            rollouts.recurrent_hidden_states[:-1].view(
-                -1, self.actor_critic.recurrent_hidden_state_size),
-            rollouts.masks[:-1].view(-1, 1),
-            rollouts.actions.view(-1, action_shape))
+        # Only the forward runs in bfloat16, the losses are computed in fp32
+        with torch.autocast(rollouts.obs.device.type, dtype=torch.bfloat16,
+                            enabled=self.amp):
+            values, action_log_probs, dist_entropy, _ = self.actor_critic.evaluate_actions(
+                rollouts.obs[:-1].view(-1, *obs_shape), 
+                rollouts.recurrent_hidden_states[:-1].view(
+                    -1, self.actor_critic.recurrent_hidden_state_size),
+                rollouts.masks[:-1].view(-1, 1),
+                rollouts.actions.view(-1, action_shape))
+        values, action_log_probs, dist_entropy = \
+            values.float(), action_log_probs.float(), dist_entropy.float()
 
         # values, action_log_probs, dist_entropy, _ = self.actor_critic.evaluate_actions(
         #     rollouts.obs[1:].view(-1, *obs_shape), 
@@ -94,4 +105,5 @@ class A2C_ACKTR():
 
         self.optimizer.step()
 
-        return value_loss.item(), action_loss.item(), dist_entropy.item()
+        # Left on the device, callers convert them only when they log
+        return value_loss.detach(), action_loss.detach(), dist_entropy.detach()
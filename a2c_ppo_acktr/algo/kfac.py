@@ -51,7 +51,7 @@ def compute_cov_g(g, classname, layer_info, fast_cnn):
 
     if classname == 'Conv2d':
         if fast_cnn:
-            g = g.view(g.size(0), g.size(1), -1)
+            g = g.reshape(g.size(0), g.size(1), -1)
             g = g.sum(-1)
         else:
             g = g.transpose(1, 2).transpose(2, 3).contiguous()
@@ -214,7 +214,7 @@ class KFACOptimizer(optim.Optimizer):
                 self.d_g[m].mul_((self.d_g[m] > 1e-6).float())
 
             if classname == 'Conv2d':
-                p_grad_mat = p.grad.data.view(p.grad.data.size(0), -1)
+                p_grad_mat = p.grad.data.reshape(p.grad.data.size(0), -1)
             else:
                 p_grad_mat = p.grad.data
 
@@ -15,7 +15,9 @@ class PPO():
                  lr=None,
                  eps=None,
                  max_grad_norm=None,
-                 use_clipped_value_loss=True):
+                 use_clipped_value_loss=True,
+                 amp=False,
+                 generator=None):
 
         self.actor_critic = actor_critic
 
@@ -28,8 +30,14 @@ class PPO():
 
         self.max_grad_norm = max_grad_norm
         self.use_clipped_value_loss = use_clipped_value_loss
+        self.amp = amp
+        self.generator = generator
 
-        self.optimizer = optim.Adam(actor_critic.parameters(), lr=lr, eps=eps)
+        # The fused kernel updates all parameters at once, it needs the
+        # policy to be on the GPU before the optimizer is built
+        self.optimizer = optim.Adam(
+            actor_critic.parameters(), lr=lr, eps=eps,
+            fused=next(actor_critic.parameters()).is_cuda)
 
     def update(self, rollouts):
         advantages = rollouts.returns[:-1] - rollouts.value_preds[:-1]
@@ -43,10 +51,12 @@ class PPO():
         for e in range(self.ppo_epoch):
             if self.actor_critic.is_recurrent:
                 data_generator = rollouts.recurrent_generator(
-                    advantages, self.num_mini_batch)
+                    advantages, self.num_mini_batch,
+                    generator=self.generator)
             else:
                 data_generator = rollouts.feed_forward_generator(
-                    advantages, self.num_mini_batch)
+                    advantages, self.num_mini_batch,
+                    generator=self.generator)
 
             for sample in data_generator:
                 obs_batch, recurrent_hidden_states_batch, actions_batch, \
@@ -54,9 +64,14 @@ class PPO():
                         adv_targ = sample
 
                 # Reshape to do in a single forward pass for all steps
-                values, action_log_probs, dist_entropy, _ = self.actor_critic.evaluate_actions(
-                    obs_batch, recurrent_hidden_states_batch, masks_batch,
-                    actions_batch)
+                # Only the forward runs in bfloat16, the losses in fp32
+                with torch.autocast(obs_batch.device.type,
+                                    dtype=torch.bfloat16, enabled=self.amp):
+                    values, action_log_probs, dist_entropy, _ = self.actor_critic.evaluate_actions(
+                        obs_batch, recurrent_hidden_states_batch, masks_batch,
+                        actions_batch)
+                values, action_log_probs, dist_entropy = values.float(), \
+                    action_log_probs.float(), dist_entropy.float()
 
                 ratio = torch.exp(action_log_probs -
                                   old_action_log_probs_batch)
@@ -83,9 +98,10 @@ class PPO():
                                          self.max_grad_norm)
                 self.optimizer.step()
 
-                value_loss_epoch += value_loss.item()
-                action_loss_epoch += action_loss.item()
-                dist_entropy_epoch += dist_entropy.item()
+                # Accumulated on the device to avoid a sync per mini batch
+                value_loss_epoch += value_loss.detach()
+                action_loss_epoch += action_loss.detach()
+                dist_entropy_epoch += dist_entropy.detach()
 
         num_updates = self.ppo_epoch * self.num_mini_batch
 
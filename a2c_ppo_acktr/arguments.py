@@ -161,13 +161,42 @@ def get_args():
         default=False,
         help='Use the IAM structure')
 # END ADDED
+    parser.add_argument(
+        '--vec-env',
+        default='shmem',
+        choices=['dummy', 'subproc', 'shmem'],
+        help='vectorized env used for training: dummy | subproc | shmem '
+        '(default: shmem)')
+    parser.add_argument(
+        '--double-buffer',
+        action='store_true',
+        default=False,
+        help='step two halves of the processes alternately so the policy '
+        'forward of one half overlaps the simulation of the other')
+    parser.add_argument(
+        '--amp',
+        action='store_true',
+        default=False,
+        help='run the policy forward passes in bfloat16 autocast (CUDA only)')
+    parser.add_argument(
+        '--compile',
+        action='store_true',
+        default=False,
+        help='compile the rollout policy with torch.compile')
     args = parser.parse_args()
 
     args.cuda = not args.no_cuda and torch.cuda.is_available()
+    args.amp = args.amp and args.cuda
 
     assert args.algo in ['a2c', 'ppo', 'acktr']
+    if args.double_buffer:
+        assert args.num_processes % 2 == 0, \
+            'Double buffering requires an even number of processes'
     if args.recurrent_policy:
         assert args.algo in ['a2c', 'ppo'], \
             'Recurrent policy is not implemented for ACKTR'
+    if args.amp:
+        assert args.algo in ['a2c', 'ppo'], \
+            'Mixed precision is not implemented for ACKTR'
 
     return args
@@ -8,6 +8,9 @@ from a2c_ppo_acktr.utils import AddBias, init
 
 """
 Modify standard PyTorch distributions so they are compatible with this code.
+
+The distributions are built without argument validation, as its checks read
+device tensors back on the host on every forward and log_probs call.
 """
 
 #
@@ -16,8 +19,10 @@ Modify standard PyTorch distributions so they are compatible with this code.
 
 # Categorical
 class FixedCategorical(torch.distributions.Categorical):
-    def sample(self):
-        return super().sample().unsqueeze(-1)
+    def sample(self, generator=None):
+        probs_2d = self.probs.reshape(-1, self._num_events)
+        samples_2d = torch.multinomial(probs_2d, 1, True, generator=generator)
+        return samples_2d.reshape(self._batch_shape + (1,))
 
     def log_probs(self, actions):
         return (
@@ -34,6 +39,10 @@ class FixedCategorical(torch.distributions.Categorical):
 
 # Normal
 class FixedNormal(torch.distributions.Normal):
+    def sample(self, generator=None):
+        with torch.no_grad():
+            return torch.normal(self.loc, self.scale, generator=generator)
+
     def log_probs(self, actions):
         return super().log_prob(actions).sum(-1, keepdim=True)
 
@@ -46,6 +55,10 @@ class FixedNormal(torch.distributions.Normal):
 
 # Bernoulli
 class FixedBernoulli(torch.distributions.Bernoulli):
+    def sample(self, generator=None):
+        with torch.no_grad():
+            return torch.bernoulli(self.probs, generator=generator)
+
     def log_probs(self, actions):
         return super.log_prob(actions).view(actions.size(0), -1).sum(-1).unsqueeze(-1)
 
@@ -70,7 +83,7 @@ class Categorical(nn.Module):
 
     def forward(self, x):
         x = self.linear(x)
-        return FixedCategorical(logits=x)
+        return FixedCategorical(logits=x, validate_args=False)
 
 
 class DiagGaussian(nn.Module):
@@ -92,7 +105,8 @@ class DiagGaussian(nn.Module):
             zeros = zeros.cuda()
 
         action_logstd = self.logstd(zeros)
-        return FixedNormal(action_mean, action_logstd.exp())
+        return FixedNormal(action_mean, action_logstd.exp(),
+                           validate_args=False)
 
 
 class Bernoulli(nn.Module):
@@ -106,4 +120,4 @@ class Bernoulli(nn.Module):
 
     def forward(self, x):
         x = self.linear(x)
-        return FixedBernoulli(logits=x)
+        return FixedBernoulli(logits=x, validate_args=False)
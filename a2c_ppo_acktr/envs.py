@@ -1,5 +1,8 @@
 import os
 import math
+import multiprocessing as mp
+from multiprocessing import shared_memory
+
 import gym
 import numpy as np
 import torch
@@ -10,9 +13,11 @@ from stable_baselines3.common.atari_wrappers import (ClipRewardEnv,
                                                      FireResetEnv,
                                                      MaxAndSkipEnv,
                                                      NoopResetEnv, WarpFrame)
+from stable_baselines3.common.env_util import is_wrapped
 from stable_baselines3.common.monitor import Monitor
 from stable_baselines3.common.vec_env import (DummyVecEnv, SubprocVecEnv,
-                                              VecEnvWrapper)
+                                              VecEnv, VecEnvWrapper)
+from stable_baselines3.common.vec_env.base_vec_env import CloudpickleWrapper
 # from stable_baselines3.common.atari_wrappers import make_atari, wrap_deepmind
 # from stable_baselines3 import bench
 from stable_baselines3.common.vec_env.vec_normalize import \
@@ -103,16 +108,35 @@ def make_vec_envs(env_name,
                   log_dir,
                   device,
                   allow_early_resets,
-                  num_frame_stack=None):
+                  num_frame_stack=None,
+                  vec_env_cls='subproc',
+                  start_rank=0,
+                  episode_returns=None,
+                  total_processes=None):
+    ranks = range(start_rank, start_rank + num_processes)
+    # Workers are pinned based on all processes of the run, not only the
+    # ones of this VecEnv
+    if total_processes is None:
+        total_processes = start_rank + num_processes
     envs = [
-        make_env(env_name, seed, i, log_dir, allow_early_resets)
-        for i in range(num_processes)
+        make_env(env_name, seed, rank, log_dir, allow_early_resets)
+        for rank in ranks
     ]
 
-    if len(envs) > 1:
-        envs = SubprocVecEnv(envs)
-    else:
+    if len(envs) == 1 or vec_env_cls == 'dummy':
         envs = DummyVecEnv(envs)
+    elif vec_env_cls == 'shmem':
+        envs = ShmemVecEnv(envs,
+                           cpus=[
+                               worker_cpu(rank, total_processes)
+                               for rank in ranks
+                           ],
+                           episode_returns=episode_returns)
+    else:
+        envs = SubprocVecEnv(envs)
+
+    if episode_returns is not None and not isinstance(envs, ShmemVecEnv):
+        envs = VecEpisodeReturns(envs, episode_returns)
 
     if len(envs.observation_space.shape) == 1:
         if gamma is None:
@@ -185,11 +209,45 @@ class VecPyTorch(VecEnvWrapper):
         """Return only every `skip`-th frame"""
         super(VecPyTorch, self).__init__(venv)
         self.device = device
-        # TODO: Fix data types
+        # Images stay uint8 all the way to the policy, which scales them
+        # itself, everything else is converted to float32
+        if (len(self.observation_space.shape) == 3
+                and self.observation_space.dtype == np.uint8):
+            self.obs_dtype = torch.uint8
+        else:
+            self.obs_dtype = torch.float32
+
+        # Stage host->device copies through pinned buffers so they can be
+        # issued with non_blocking=True and overlap the next Python work
+        self._copy_done = None
+        if torch.device(device).type == 'cuda':
+            self._obs_buffer = torch.empty(
+                (self.num_envs, ) + self.observation_space.shape,
+                dtype=self.obs_dtype, pin_memory=True)
+            self._reward_buffer = torch.empty(self.num_envs, 1,
+                                              pin_memory=True)
+            self._copy_done = torch.cuda.Event()
+
+    def _to_device(self, obs, reward=None):
+        if self._copy_done is None:
+            obs = torch.from_numpy(obs).to(self.device, self.obs_dtype)
+            if reward is not None:
+                reward = torch.from_numpy(reward).unsqueeze(dim=1).float()
+            return obs, reward
+
+        # The previous copies may still be reading the pinned buffers
+        self._copy_done.synchronize()
+        self._obs_buffer.copy_(torch.from_numpy(obs))
+        obs = self._obs_buffer.to(self.device, non_blocking=True)
+        if reward is not None:
+            self._reward_buffer.copy_(torch.from_numpy(reward).unsqueeze(dim=1))
+            reward = self._reward_buffer.to(self.device, non_blocking=True)
+        self._copy_done.record()
+        return obs, reward
 
     def reset(self):
         obs = self.venv.reset()
-        obs = torch.from_numpy(obs).float().to(self.device)
+        obs, _ = self._to_device(obs)
         return obs
 
     def step_async(self, actions):
@@ -201,8 +259,7 @@ class VecPyTorch(VecEnvWrapper):
 
     def step_wait(self):
         obs, reward, done, info = self.venv.step_wait()
-        obs = torch.from_numpy(obs).float().to(self.device)
-        reward = torch.from_numpy(reward).unsqueeze(dim=1).float()
+        obs, reward = self._to_device(obs, reward)
         return obs, reward, done, info
 
 
@@ -244,8 +301,8 @@ class VecPyTorchFrameStack(VecEnvWrapper):
 
         if device is None:
             device = torch.device('cpu')
-        self.stacked_obs = torch.zeros((venv.num_envs, ) +
-                                       low.shape).to(device)
+        self.stacked_obs = torch.zeros((venv.num_envs, ) + low.shape,
+                                       dtype=venv.obs_dtype).to(device)
 
         observation_space = gym.spaces.Box(low=low,
                                            high=high,
@@ -265,7 +322,8 @@ class VecPyTorchFrameStack(VecEnvWrapper):
     def reset(self):
         obs = self.venv.reset()
         if torch.backends.cudnn.deterministic:
-            self.stacked_obs = torch.zeros(self.stacked_obs.shape)
+            self.stacked_obs = torch.zeros(self.stacked_obs.shape,
+                                           dtype=self.stacked_obs.dtype)
         else:
             self.stacked_obs.zero_()
         self.stacked_obs[:, -self.shape_dim0:] = obs
@@ -273,3 +331,220 @@ class VecPyTorchFrameStack(VecEnvWrapper):
 
     def close(self):
         self.venv.close()
+
+
+try:
+    _CPUS = sorted(os.sched_getaffinity(0))
+except AttributeError:
+    # Not available on macOS and Windows, workers are not pinned there
+    _CPUS = None
+
+
+def _pin_workers(num_processes):
+    # Only pin when every worker gets a CPU of its own and the first one
+    # still stays free for the learner, otherwise leave it to the scheduler
+    return _CPUS is not None and num_processes < len(_CPUS)
+
+
+def worker_cpu(rank, num_processes):
+    """CPU the env worker of the given rank out of `num_processes` is pinned
+    to, or None if the workers are not pinned.
+
+    The first available CPU is skipped so it stays free for the learner.
+    """
+    if not _pin_workers(num_processes):
+        return None
+    return _CPUS[rank + 1]
+
+
+def learner_cpus(num_processes):
+    """CPUs not used by `num_processes` pinned workers, or None if the
+    workers are not pinned"""
+    if not _pin_workers(num_processes):
+        return None
+    return _CPUS[:1] + _CPUS[num_processes + 1:]
+
+
+def _default_start_method():
+    if 'forkserver' in mp.get_all_start_methods():
+        return 'forkserver'
+    return 'spawn'
+
+
+class EpisodeReturnBuffer(object):
+    def __init__(self, maxlen, start_method=None):
+        """
+        Ring buffer of the last `maxlen` episode returns reported by Monitor.
+        ShmemVecEnv workers append to it directly, so the training loop does
+        not have to scan the infos of every step.
+        """
+        if start_method is None:
+            start_method = _default_start_method()
+        ctx = mp.get_context(start_method)
+        self.maxlen = maxlen
+        self._returns = ctx.Array('d', maxlen, lock=False)
+        self._count = ctx.Value('q', 0)
+
+    def append(self, episode_return):
+        with self._count.get_lock():
+            self._returns[self._count.value % self.maxlen] = episode_return
+            self._count.value += 1
+
+    def __len__(self):
+        return min(self._count.value, self.maxlen)
+
+    def values(self):
+        """Copy of the stored returns, in no particular order"""
+        with self._count.get_lock():
+            return np.frombuffer(self._returns, dtype=np.float64)[:len(self)].copy()
+
+
+class VecEpisodeReturns(VecEnvWrapper):
+    def __init__(self, venv, episode_returns):
+        """
+        Collect Monitor episode returns into an EpisodeReturnBuffer for
+        vectorized envs whose workers cannot do it themselves
+        """
+        super(VecEpisodeReturns, self).__init__(venv)
+        self.episode_returns = episode_returns
+
+    def reset(self):
+        return self.venv.reset()
+
+    def step_wait(self):
+        obs, reward, done, infos = self.venv.step_wait()
+        for info in infos:
+            if 'episode' in info:
+                self.episode_returns.append(info['episode']['r'])
+        return obs, reward, done, infos
+
+
+def _shmem_worker(remote, parent_remote, env_fn_wrapper, cpu,
+                  episode_returns):
+    parent_remote.close()
+    if cpu is not None:
+        os.sched_setaffinity(0, {cpu})
+    env = env_fn_wrapper.var()
+    shm, obs_buffer = None, None
+    while True:
+        try:
+            cmd, data = remote.recv()
+            if cmd == 'step':
+                observation, reward, done, info = env.step(data)
+                if done:
+                    info['terminal_observation'] = observation
+                    observation = env.reset()
+                if episode_returns is not None and 'episode' in info:
+                    episode_returns.append(info['episode']['r'])
+                obs_buffer[...] = observation
+                remote.send((reward, done, info))
+            elif cmd == 'reset':
+                obs_buffer[...] = env.reset()
+                remote.send(None)
+            elif cmd == 'attach':
+                name, index, shape, dtype = data
+                # The parent owns the segment and unlinks it on close. The
+                # workers share its resource tracker, which already holds
+                # the parent's registration, so attaching adds nothing.
+                shm = shared_memory.SharedMemory(name=name)
+                obs_buffer = np.ndarray(
+                    shape, dtype=dtype, buffer=shm.buf)[index]
+                remote.send(None)
+            elif cmd == 'seed':
+                remote.send(env.seed(data))
+            elif cmd == 'render':
+                remote.send(env.render(data))
+            elif cmd == 'close':
+                env.close()
+                remote.close()
+                break
+            elif cmd == 'get_spaces':
+                remote.send((env.observation_space, env.action_space))
+            elif cmd == 'env_method':
+                method = getattr(env, data[0])
+                remote.send(method(*data[1], **data[2]))
+            elif cmd == 'get_attr':
+                remote.send(getattr(env, data))
+            elif cmd == 'set_attr':
+                remote.send(setattr(env, data[0], data[1]))
+            elif cmd == 'is_wrapped':
+                remote.send(is_wrapped(env, data))
+            else:
+                raise NotImplementedError
+        except EOFError:
+            break
+    if shm is not None:
+        del obs_buffer
+        shm.close()
+
+
+# Derived from
+# https://github.com/openai/baselines/blob/master/baselines/common/vec_env/shmem_vec_env.py
+class ShmemVecEnv(SubprocVecEnv):
+    def __init__(self, env_fns, cpus=None, episode_returns=None,
+                 start_method=None):
+        """
+        Subprocess vectorized env whose workers write observations into a
+        shared memory buffer instead of pickling them through the pipes.
+        If an EpisodeReturnBuffer is given, the workers append the Monitor
+        episode returns to it (it must use the same start method).
+        """
+        self.waiting = False
+        self.closed = False
+        n_envs = len(env_fns)
+        if cpus is None:
+            cpus = [None] * n_envs
+
+        if start_method is None:
+            start_method = _default_start_method()
+        ctx = mp.get_context(start_method)
+
+        self.remotes, self.work_remotes = zip(
+            *[ctx.Pipe() for _ in range(n_envs)])
+        self.processes = []
+        for work_remote, remote, env_fn, cpu in zip(
+                self.work_remotes, self.remotes, env_fns, cpus):
+            args = (work_remote, remote, CloudpickleWrapper(env_fn), cpu,
+                    episode_returns)
+            process = ctx.Process(target=_shmem_worker, args=args, daemon=True)
+            process.start()
+            self.processes.append(process)
+            work_remote.close()
+
+        self.remotes[0].send(('get_spaces', None))
+        observation_space, action_space = self.remotes[0].recv()
+        assert isinstance(observation_space, Box), \
+            "ShmemVecEnv only supports Box observation spaces"
+        VecEnv.__init__(self, n_envs, observation_space, action_space)
+
+        shape = (n_envs, ) + observation_space.shape
+        dtype = np.dtype(observation_space.dtype)
+        self._shm = shared_memory.SharedMemory(
+            create=True, size=int(np.prod(shape)) * dtype.itemsize)
+        self._obs = np.ndarray(shape, dtype=dtype, buffer=self._shm.buf)
+        for index, remote in enumerate(self.remotes):
+            remote.send(('attach', (self._shm.name, index, shape, dtype)))
+        for remote in self.remotes:
+            remote.recv()
+
+    def step_wait(self):
+        results = [remote.recv() for remote in self.remotes]
+        self.waiting = False
+        rews, dones, infos = zip(*results)
+        # Zero-copy: the buffer is only rewritten by the next step/reset
+        return self._obs, np.stack(rews), np.stack(dones), infos
+
+    def reset(self):
+        for remote in self.remotes:
+            remote.send(('reset', None))
+        for remote in self.remotes:
+            remote.recv()
+        return self._obs
+
+    def close(self):
+        if self.closed:
+            return
+        super(ShmemVecEnv, self).close()
+        del self._obs
+        self._shm.close()
+        self._shm.unlink()
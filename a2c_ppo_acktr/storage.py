@@ -1,15 +1,35 @@
 import torch
-from torch.utils.data.sampler import BatchSampler, SubsetRandomSampler
 
 
 def _flatten_helper(T, N, _tensor):
     return _tensor.view(T * N, *_tensor.size()[2:])
 
 
+def _reverse_discounted_sum(x, c, last):
+    """
+    Solves y[t] = x[t] + c[t] * y[t + 1] for all t < T with y[T] = last.
+
+    x and c are (T, N, 1) tensors and last is (N, 1). Instead of a loop over
+    the steps, y[t] is computed as the sum over k >= t of x[k] (with
+    x[T] = last) weighted by the discount product c[t] * ... * c[k - 1].
+    """
+    T = x.size(0)
+    steps = torch.arange(T + 1, device=x.device)
+    # from_t[t, k] is true for k >= t
+    from_t = (steps.view(1, -1) >= steps[:T].view(-1, 1)).view(T, T + 1, 1, 1)
+    # Replace c[k] by 1 before t so the cumulative product starts at t
+    discounts = torch.where(from_t[:, :T], c.unsqueeze(0),
+                            torch.ones_like(c).unsqueeze(0)).cumprod(1)
+    discounts = torch.cat([torch.ones_like(discounts[:, :1]), discounts], 1)
+    x = torch.cat([x, last.unsqueeze(0)], 0)
+    return (discounts * from_t * x.unsqueeze(0)).sum(1)
+
+
 class RolloutStorage(object):
     def __init__(self, num_steps, num_processes, obs_shape, action_space,
-                 recurrent_hidden_state_size):
-        self.obs = torch.zeros(num_steps + 1, num_processes, *obs_shape)
+                 recurrent_hidden_state_size, obs_dtype=torch.float32):
+        self.obs = torch.zeros(num_steps + 1, num_processes, *obs_shape,
+                               dtype=obs_dtype)
         self.recurrent_hidden_states = torch.zeros(
             num_steps + 1, num_processes, recurrent_hidden_state_size)
         self.rewards = torch.zeros(num_steps, num_processes, 1)
@@ -45,30 +65,55 @@ class RolloutStorage(object):
 
     def insert(self, obs, recurrent_hidden_states, actions, action_log_probs,
                value_preds, rewards, masks, bad_masks):
-        self.obs[self.step + 1].copy_(obs)
-        self.recurrent_hidden_states[self.step +
-                                     1].copy_(recurrent_hidden_states)
-        self.actions[self.step].copy_(actions)
-        self.action_log_probs[self.step].copy_(action_log_probs)
-        self.value_preds[self.step].copy_(value_preds)
-        self.rewards[self.step].copy_(rewards)
-        self.masks[self.step + 1].copy_(masks)
-        self.bad_masks[self.step + 1].copy_(bad_masks)
+        self.insert_policy(self.step, slice(None), recurrent_hidden_states,
+                           actions, action_log_probs, value_preds)
+        self.insert_env(self.step, slice(None), obs, rewards, masks,
+                        bad_masks)
 
         self.step = (self.step + 1) % self.num_steps
 
+    def insert_policy(self, step, envs, recurrent_hidden_states, actions,
+                      action_log_probs, value_preds):
+        """Insert the policy outputs of the processes in `envs` at `step`"""
+        torch._foreach_copy_(
+            list(self.policy_outputs(step, envs)),
+            [value_preds, actions, action_log_probs, recurrent_hidden_states])
+
+    def policy_outputs(self, step, envs):
+        """
+        Views of the storage the policy outputs of the processes in `envs` at
+        `step` belong to, in the order returned by IAMPolicy.act
+        """
+        return (self.value_preds[step, envs], self.actions[step, envs],
+                self.action_log_probs[step, envs],
+                self.recurrent_hidden_states[step + 1, envs])
+
+    def insert_env(self, step, envs, obs, rewards, masks, bad_masks):
+        """Insert the env transition of the processes in `envs` at `step`"""
+        torch._foreach_copy_([
+            self.obs[step + 1, envs], self.rewards[step, envs],
+            self.masks[step + 1, envs], self.bad_masks[step + 1, envs]
+        ], [obs, rewards, masks, bad_masks])
+
     def after_update(self):
-        self.obs[0].copy_(self.obs[-1])
-        self.recurrent_hidden_states[0].copy_(self.recurrent_hidden_states[-1])
-        self.masks[0].copy_(self.masks[-1])
-        self.bad_masks[0].copy_(self.bad_masks[-1])
+        buffers = [
+            self.obs, self.recurrent_hidden_states, self.masks, self.bad_masks
+        ]
+        torch._foreach_copy_([b[0] for b in buffers], [b[-1] for b in buffers])
 
     def compute_returns(self,
                         next_value,
                         use_gae,
                         gamma,
                         gae_lambda,
-                        use_proper_time_limits=True):
+                        use_proper_time_limits=True,
+                        vectorized=True):
+        if vectorized:
+            self._compute_returns_vectorized(next_value, use_gae, gamma,
+                                             gae_lambda,
+                                             use_proper_time_limits)
+            return
+
         if use_proper_time_limits:
             if use_gae:
                 self.value_preds[-1] = next_value
@@ -104,10 +149,34 @@ class RolloutStorage(object):
                     self.returns[step] = self.returns[step + 1] * \
                         gamma * self.masks[step + 1] + self.rewards[step]
 
+    def _compute_returns_vectorized(self, next_value, use_gae, gamma,
+                                    gae_lambda, use_proper_time_limits):
+        # Same recursions as the loops in compute_returns, written as
+        # y[t] = x[t] + c[t] * y[t + 1] and solved in one pass
+        masks = self.masks[1:]
+        bad_masks = self.bad_masks[1:] if use_proper_time_limits else 1
+        if use_gae:
+            self.value_preds[-1] = next_value
+            deltas = self.rewards + gamma * self.value_preds[1:] * masks \
+                - self.value_preds[:-1]
+            gae = _reverse_discounted_sum(
+                deltas * bad_masks, gamma * gae_lambda * masks * bad_masks,
+                torch.zeros_like(next_value))
+            self.returns[:-1] = gae + self.value_preds[:-1]
+        else:
+            self.returns[-1] = next_value
+            rewards = self.rewards
+            if use_proper_time_limits:
+                rewards = rewards * bad_masks + (
+                    1 - bad_masks) * self.value_preds[:-1]
+            self.returns[:-1] = _reverse_discounted_sum(
+                rewards, gamma * masks * bad_masks, next_value)
+
     def feed_forward_generator(self,
                                advantages,
                                num_mini_batch=None,
-                               mini_batch_size=None):
+                               mini_batch_size=None,
+                               generator=None):
         num_steps, num_processes = self.rewards.size()[0:2]
         batch_size = num_processes * num_steps
 
@@ -119,11 +188,13 @@ class RolloutStorage(object):
                 "".format(num_processes, num_steps, num_processes * num_steps,
                           num_mini_batch))
             mini_batch_size = batch_size // num_mini_batch
-        sampler = BatchSampler(
-            SubsetRandomSampler(range(batch_size)),
-            mini_batch_size,
-            drop_last=True)
-        for indices in sampler:
+        # Shuffle on the storage device so the minibatch indices never have
+        # to be built on the host and copied over
+        perm = torch.randperm(
+            batch_size, device=self.rewards.device, generator=generator)
+        for start_ind in range(0, batch_size - mini_batch_size + 1,
+                               mini_batch_size):
+            indices = perm[start_ind:start_ind + mini_batch_size]
             obs_batch = self.obs[:-1].view(-1, *self.obs.size()[2:])[indices]
             recurrent_hidden_states_batch = self.recurrent_hidden_states[:-1].view(
                 -1, self.recurrent_hidden_states.size(-1))[indices]
@@ -142,51 +213,34 @@ class RolloutStorage(object):
             yield obs_batch, recurrent_hidden_states_batch, actions_batch, \
                 value_preds_batch, return_batch, masks_batch, old_action_log_probs_batch, adv_targ
 
-    def recurrent_generator(self, advantages, num_mini_batch):
+    def recurrent_generator(self, advantages, num_mini_batch, generator=None):
         num_processes = self.rewards.size(1)
         assert num_processes >= num_mini_batch, (
             "PPO requires the number of processes ({}) "
             "to be greater than or equal to the number of "
             "PPO mini batches ({}).".format(num_processes, num_mini_batch))
         num_envs_per_batch = num_processes // num_mini_batch
-        perm = torch.randperm(num_processes)
-        for start_ind in range(0, num_processes, num_envs_per_batch):
-            obs_batch = []
-            recurrent_hidden_states_batch = []
-            actions_batch = []
-            value_preds_batch = []
-            return_batch = []
-            masks_batch = []
-            old_action_log_probs_batch = []
-            adv_targ = []
-
-            for offset in range(num_envs_per_batch):
-                ind = perm[start_ind + offset]
-                obs_batch.append(self.obs[:-1, ind])
-                recurrent_hidden_states_batch.append(
-                    self.recurrent_hidden_states[0:1, ind])
-                actions_batch.append(self.actions[:, ind])
-                value_preds_batch.append(self.value_preds[:-1, ind])
-                return_batch.append(self.returns[:-1, ind])
-                masks_batch.append(self.masks[:-1, ind])
-                old_action_log_probs_batch.append(
-                    self.action_log_probs[:, ind])
-                adv_targ.append(advantages[:, ind])
+        perm = torch.randperm(
+            num_processes, device=self.rewards.device, generator=generator)
+        # Like the feed forward minibatches, leftover processes are dropped
+        for start_ind in range(0, num_mini_batch * num_envs_per_batch,
+                               num_envs_per_batch):
+            # Gather the whole group of processes at once, indexing with a
+            # single device tensor element would sync on its value
+            ind = perm[start_ind:start_ind + num_envs_per_batch]
 
             T, N = self.num_steps, num_envs_per_batch
             # These are all tensors of size (T, N, -1)
-            obs_batch = torch.stack(obs_batch, 1)
-            actions_batch = torch.stack(actions_batch, 1)
-            value_preds_batch = torch.stack(value_preds_batch, 1)
-            return_batch = torch.stack(return_batch, 1)
-            masks_batch = torch.stack(masks_batch, 1)
-            old_action_log_probs_batch = torch.stack(
-                old_action_log_probs_batch, 1)
-            adv_targ = torch.stack(adv_targ, 1)
+            obs_batch = self.obs[:-1, ind]
+            actions_batch = self.actions[:, ind]
+            value_preds_batch = self.value_preds[:-1, ind]
+            return_batch = self.returns[:-1, ind]
+            masks_batch = self.masks[:-1, ind]
+            old_action_log_probs_batch = self.action_log_probs[:, ind]
+            adv_targ = advantages[:, ind]
 
             # States is just a (N, -1) tensor
-            recurrent_hidden_states_batch = torch.stack(
-                recurrent_hidden_states_batch, 1).view(N, -1)
+            recurrent_hidden_states_batch = self.recurrent_hidden_states[0, ind]
 
             # Flatten the (T, N, ...) tensors to (T * N, ...)
             obs_batch = _flatten_helper(T, N, obs_batch)
@@ -1,11 +1,17 @@
 import glob
 import os
 
+import numpy as np
 import torch
 import torch.nn as nn
 
 from a2c_ppo_acktr.envs import VecNormalize
 
+try:
+    import numba
+except ImportError:
+    numba = None
+
 
 # Get a render function
 def get_render_func(venv):
@@ -28,6 +34,38 @@ def get_vec_normalize(venv):
     return None
 
 
+def _fill_masks_numpy(done, bad_transition, out):
+    np.subtract(1.0, done, out=out[0])
+    np.subtract(1.0, bad_transition, out=out[1])
+
+
+def _fill_masks_loop(done, bad_transition, out):
+    for i in range(done.shape[0]):
+        out[0, i] = 0.0 if done[i] else 1.0
+        out[1, i] = 0.0 if bad_transition[i] else 1.0
+
+
+# The loop is only worth it compiled, plain Python uses numpy instead
+_fill_masks = (_fill_masks_numpy if numba is None else
+               numba.njit(cache=True)(_fill_masks_loop))
+
+
+def build_masks(done, infos, out=None):
+    """
+    Builds the masks and bad masks of a vec env step as one (2, N, 1)
+    float32 array, so both reach the device with a single copy. If `out` is
+    given the masks are written into it instead of a new array.
+    """
+    bad_transition = np.fromiter(
+        ('bad_transition' in info for info in infos),
+        dtype=np.bool_, count=len(infos))
+    if out is None:
+        out = np.empty((2, len(infos), 1), dtype=np.float32)
+    _fill_masks(np.asarray(done, dtype=np.bool_), bad_transition,
+                out[..., 0])
+    return out
+
+
 # Necessary for my KFAC implementation.
 class AddBias(nn.Module):
     def __init__(self, bias):
@@ -1,8 +1,9 @@
 import copy
+import functools
 import glob
 import os
 import time
-from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 
 import gym
 import numpy as np
@@ -14,13 +15,12 @@ import torch.optim as optim
 from a2c_ppo_acktr import algo, utils
 from a2c_ppo_acktr.algo import gail
 from a2c_ppo_acktr.arguments import get_args
-from a2c_ppo_acktr.envs import make_vec_envs
+from a2c_ppo_acktr.envs import (EpisodeReturnBuffer, learner_cpus,
+                                make_vec_envs)
 from a2c_ppo_acktr.IAMModel import IAMPolicy
 from a2c_ppo_acktr.storage import RolloutStorage
 from evaluation import evaluate
 
-import pickle
-
 """
     NOTE:
     Default arguments overview:
@@ -52,11 +52,55 @@ def main():
     utils.cleanup_log_dir(log_dir)
     utils.cleanup_log_dir(eval_log_dir)
 
-    torch.set_num_threads(1)
     device = torch.device("cuda:0" if args.cuda else "cpu")
 
-    envs = make_vec_envs(args.env_name, args.seed, args.num_processes,
-                         args.gamma, args.log_dir, device, False)
+    # The policy forwards run in bfloat16 with --amp, opt in to TF32 for the
+    # fp32 matmuls that remain
+    autocast = functools.partial(torch.autocast, device.type,
+                                 dtype=torch.bfloat16, enabled=args.amp)
+    if args.amp:
+        torch.set_float32_matmul_precision('high')
+
+    # Monitor returns of the last 10 training episodes, filled by the envs
+    episode_rewards = EpisodeReturnBuffer(maxlen=10)
+
+    # With double buffering the processes are split into two groups that are
+    # stepped alternately, so one group simulates while the policy runs on
+    # the other. Each group has its own VecEnv and slice of the rollouts.
+    num_groups = 2 if args.double_buffer else 1
+    group_size = args.num_processes // num_groups
+    env_groups = []
+    for group in range(num_groups):
+        start_rank = group * group_size
+        group_envs = make_vec_envs(args.env_name, args.seed, group_size,
+                                   args.gamma, args.log_dir, device, False,
+                                   vec_env_cls=args.vec_env,
+                                   start_rank=start_rank,
+                                   episode_returns=episode_rewards,
+                                   total_processes=args.num_processes)
+        env_groups.append(
+            (group_envs, slice(start_rank, start_rank + group_size)))
+    # Spaces, checkpoints and GAIL filtering use the first group
+    envs = env_groups[0][0]
+    # The groups share one set of normalization statistics, so the whole
+    # batch is normalized and reward-scaled the same way
+    shared_norm = utils.get_vec_normalize(envs)
+    for group_envs, _ in env_groups[1:]:
+        group_norm = utils.get_vec_normalize(group_envs)
+        if group_norm is not None:
+            group_norm.obs_rms = shared_norm.obs_rms
+            group_norm.ret_rms = shared_norm.ret_rms
+
+    # On CPU runs a single thread avoids oversubscribing the cores the envs
+    # need. On CUDA runs a few intra-op threads still speed up the host-side
+    # tensor work, on the CPUs the shmem env workers are not pinned to.
+    # Without enough CPUs to pin every worker, nothing is pinned.
+    cpus = learner_cpus(args.num_processes)
+    if cpus is None:
+        cpus = range(max(1, os.cpu_count() - args.num_processes))
+    elif args.vec_env == 'shmem':
+        os.sched_setaffinity(0, cpus)
+    torch.set_num_threads(min(4, len(cpus)) if args.cuda else 1)
   
     actor_critic = IAMPolicy(
         envs.observation_space.shape,
@@ -66,6 +110,22 @@ def main():
                     'IAM': args.IAM})
     actor_critic.to(device)
 
+    # Action sampling, PPO minibatches and flicker all draw from a generator
+    # on the policy device, so none of them round-trips through the host RNG
+    generator = torch.Generator(device=device)
+    generator.manual_seed(args.seed)
+
+    act, get_value = actor_critic.act, actor_critic.get_value
+    if args.compile:
+        # num_processes is fixed, so the rollout shapes never change. An
+        # explicit generator would break the graph, compiled sampling uses
+        # the on-device RNG of the generated kernels instead
+        act = torch.compile(act, mode="reduce-overhead", dynamic=False)
+        get_value = torch.compile(get_value, mode="reduce-overhead",
+                                  dynamic=False)
+    else:
+        act = functools.partial(act, generator=generator)
+
     if args.algo == 'a2c':
         agent = algo.A2C_ACKTR(
             actor_critic,
@@ -74,7 +134,8 @@ def main():
             lr=args.lr,
             eps=args.eps,
             alpha=args.alpha,
-            max_grad_norm=args.max_grad_norm)
+            max_grad_norm=args.max_grad_norm,
+            amp=args.amp)
     elif args.algo == 'ppo':
         agent = algo.PPO(
             actor_critic,
@@ -85,7 +146,9 @@ def main():
             args.entropy_coef,
             lr=args.lr,
             eps=args.eps,
-            max_grad_norm=args.max_grad_norm)
+            max_grad_norm=args.max_grad_norm,
+            amp=args.amp,
+            generator=generator)
     elif args.algo == 'acktr':
         agent = algo.A2C_ACKTR(
             actor_critic, args.value_loss_coef, args.entropy_coef, acktr=True)
@@ -110,142 +173,214 @@ def main():
 
     rollouts = RolloutStorage(args.num_steps, args.num_processes,
                               envs.observation_space.shape, envs.action_space,
-                              actor_critic.recurrent_hidden_state_size)
+                              actor_critic.recurrent_hidden_state_size,
+                              obs_dtype=envs.obs_dtype)
 
-    obs = envs.reset()
-    rollouts.obs[0].copy_(obs)
     rollouts.to(device)
+    for group_envs, group_slice in env_groups:
+        obs = group_envs.reset()
+        rollouts.obs[0, group_slice].copy_(obs)
 
-    episode_rewards = deque(maxlen=10)
     # ADDED: 
     # Store the mean reward value over processes with the frequency of log_mean_interval
-    mean_episode_rewards = []
-    max_episode_rewards = []
-    log_mean_interval = 10
-
-    start = time.time()
-    num_updates = int(
-        args.num_env_steps) // args.num_steps // args.num_processes
-
-    for j in range(num_updates):
-        # envs.render()
-        if args.use_linear_lr_decay:
-            # decrease learning rate linearly
-            utils.update_linear_schedule(
-                agent.optimizer, j, num_updates,
-                agent.optimizer.lr if args.algo == "acktr" else args.lr)
-
-        for step in range(args.num_steps):
-            # Sample actions
-            with torch.no_grad():
-                value, action, action_log_prob, recurrent_hidden_states = actor_critic.act(
-                    rollouts.obs[step], rollouts.recurrent_hidden_states[step],
-                    rollouts.masks[step])
-
-            # Obser reward and next obs
-            obs, reward, done, infos = envs.step(action)
-
-            # ADDED
-            if args.flicker:
-                prob_flicker = np.random.uniform(0, 1, (obs.shape[0],))
-                obs[prob_flicker > 0.5] = 0
-            # END ADDED
-
-            for info in infos:
-                if 'episode' in info.keys():
-                    episode_rewards.append(info['episode']['r'])
-
-            # If done then clean the history of observations.
-            masks = torch.FloatTensor(
-                [[0.0] if done_ else [1.0] for done_ in done])
-            bad_masks = torch.FloatTensor(
-                [[0.0] if 'bad_transition' in info.keys() else [1.0]
-                 for info in infos])
-            rollouts.insert(obs, recurrent_hidden_states, action,
-                            action_log_prob, value, reward, masks, bad_masks)
-
-        with torch.no_grad():
-            next_value = actor_critic.get_value(
-                rollouts.obs[-1], rollouts.recurrent_hidden_states[-1],
-                rollouts.masks[-1]).detach()
-
-        if args.gail:
-            if j >= 10:
-                envs.venv.eval()
-
-            gail_epoch = args.gail_epoch
-            if j < 10:
-                gail_epoch = 100  # Warm up
-            for _ in range(gail_epoch):
-                discr.update(gail_train_loader, rollouts,
-                             utils.get_vec_normalize(envs)._obfilt)
-
-            for step in range(args.num_steps):
-                rollouts.rewards[step] = discr.predict_reward(
-                    rollouts.obs[step], rollouts.actions[step], args.gamma,
-                    rollouts.masks[step])
-
-        rollouts.compute_returns(next_value, args.use_gae, args.gamma,
-                                 args.gae_lambda, args.use_proper_time_limits)
-
-        value_loss, action_loss, dist_entropy = agent.update(rollouts)
-
-        rollouts.after_update()
-
-        # save for every interval-th episode or for the last epoch
-        if (j % args.save_interval == 0
-                or j == num_updates - 1) and args.save_dir != "":
-            save_path = os.path.join(args.save_dir, args.algo)
-            try:
-                os.makedirs(save_path)
-            except OSError:
-                pass
-
-            torch.save([
-                actor_critic,
-                getattr(utils.get_vec_normalize(envs), 'obs_rms', None)
-            ], os.path.join(save_path, args.env_name + ".pt"))
-
-        if j % args.log_interval == 0 and len(episode_rewards) > 1:
-            total_num_steps = (j + 1) * args.num_processes * args.num_steps
-            end = time.time()
-            print(
-                "Updates {}, num timesteps {}, FPS {} \n Last {} training episodes: mean/median reward {:.1f}/{:.1f}, min/max reward {:.1f}/{:.1f}\n"
-                .format(j, total_num_steps,
-                        int(total_num_steps / (end - start)),
-                        len(episode_rewards), np.mean(episode_rewards),
-                        np.median(episode_rewards), np.min(episode_rewards),
-                        np.max(episode_rewards), dist_entropy, value_loss,
-                        action_loss))
-            
-        if (args.eval_interval is not None and len(episode_rewards) > 1
-                and j % args.eval_interval == 0):
-            obs_rms = utils.get_vec_normalize(envs).obs_rms
-            evaluate(actor_critic, obs_rms, args.env_name, args.seed,
-                     args.num_processes, eval_log_dir, device)
-        
-        # ADDED:
-        if j % log_mean_interval == 0 and len(episode_rewards) > 1:
-            mean_episode_rewards.append(np.mean(episode_rewards))
-            max_episode_rewards.append(np.amax(episode_rewards))
-    
-    # ADDED:
+    # Each record is a float32 (mean, max) pair, written as soon as it is
+    # computed so a crashed run keeps everything logged so far
     if args.IAM:
         log_mean_file = log_dir + 'mean_rewards_IAM.txt'
-        with open(log_mean_file, 'wb') as f:
-            pickle.dump(mean_episode_rewards, f)
     elif args.recurrent_policy:
         log_mean_file = log_dir + 'mean_rewards_GRU.txt'
-        with open(log_mean_file, 'wb') as f:
-            pickle.dump(mean_episode_rewards, f)
     elif args.num_steps == 10:
         log_mean_file = log_dir + 'mean_rewards_FNN1.txt'
-        with open(log_mean_file, 'wb') as f:
-            pickle.dump(mean_episode_rewards, f)
     else:
         log_mean_file = log_dir + 'mean_rewards_FNN8.txt'
-        with open(log_mean_file, 'wb') as f:
-            pickle.dump(mean_episode_rewards, f)
+    log_mean_f = open(log_mean_file, 'wb')
+    log_mean_interval = 10
+
+    # On CUDA each group builds its masks in a reused pinned buffer, the
+    # event tells when the previous copy out of it has finished
+    mask_staging = {}
+    if args.cuda:
+        for group_envs, _ in env_groups:
+            mask_staging[group_envs] = (torch.empty(
+                (2, group_size, 1), pin_memory=True), torch.cuda.Event())
+
+    def _insert_env_step(step, group_envs, group_slice, obs, reward, done,
+                         infos):
+        # If done then clean the history of observations.
+        staging = mask_staging.get(group_envs)
+        if staging is None:
+            masks = torch.from_numpy(utils.build_masks(done, infos))
+        else:
+            mask_buffer, copy_done = staging
+            copy_done.synchronize()
+            utils.build_masks(done, infos, out=mask_buffer.numpy())
+            masks = mask_buffer.to(device, non_blocking=True)
+            copy_done.record()
+        masks, bad_masks = masks
+        rollouts.insert_env(step, group_slice, obs, reward, masks, bad_masks)
+
+    def _step_plain(step, group_envs, group_slice):
+        # Obser reward and next obs
+        obs, reward, done, infos = group_envs.step_wait()
+        _insert_env_step(step, group_envs, group_slice, obs, reward, done,
+                         infos)
+
+    def _step_with_flicker(step, group_envs, group_slice):
+        # Obser reward and next obs
+        obs, reward, done, infos = group_envs.step_wait()
+
+        # ADDED
+        flicker = torch.rand(obs.size(0), device=obs.device,
+                             generator=generator) > 0.5
+        obs.masked_fill_(flicker.view(-1, *[1] * (obs.dim() - 1)), 0)
+        # END ADDED
+
+        _insert_env_step(step, group_envs, group_slice, obs, reward, done,
+                         infos)
+
+    # Pick the env step variant once instead of checking args every step
+    if args.flicker:
+        env_step = _step_with_flicker
+    else:
+        env_step = _step_plain
+
+    # Hoist the argument lookups out of the training loop
+    num_steps = args.num_steps
+    use_linear_lr_decay = args.use_linear_lr_decay
+    initial_lr = agent.optimizer.lr if args.algo == "acktr" else args.lr
+    use_gail = args.gail
+    do_save = args.save_dir != ""
+    if do_save:
+        save_path = os.path.join(args.save_dir, args.algo)
+        os.makedirs(save_path, exist_ok=True)
+    save_interval = args.save_interval
+    log_interval = args.log_interval
+    eval_interval = args.eval_interval
+
+    # get_vec_normalize walks the wrapper chain, look it up only once
+    vec_norm = utils.get_vec_normalize(envs)
+    obfilt = vec_norm._obfilt if vec_norm is not None else None
+
+    checkpoint_executor = ThreadPoolExecutor(max_workers=1)
+    checkpoint_future = None
+
+    start = time.time()
+    num_updates = int(
+        args.num_env_steps) // args.num_steps // args.num_processes
+
+    try:
+        for j in range(num_updates):
+            # envs.render()
+            if use_linear_lr_decay:
+                # decrease learning rate linearly
+                utils.update_linear_schedule(
+                    agent.optimizer, j, num_updates, initial_lr)
+
+            # Each group waits for its previous step and immediately queues the
+            # next one, so with two groups the policy forward of one group runs
+            # while the other group is simulating.
+            for step in range(num_steps + 1):
+                for group_envs, group_slice in env_groups:
+                    if step > 0:
+                        env_step(step - 1, group_envs, group_slice)
+                    if step == num_steps:
+                        continue
+
+                    # Sample actions straight into the rollout storage, which
+                    # also keeps them valid across the other group's forward
+                    with torch.inference_mode(), autocast():
+                        _, action, _, _ = act(
+                            rollouts.obs[step, group_slice],
+                            rollouts.recurrent_hidden_states[step,
+                                                             group_slice],
+                            rollouts.masks[step, group_slice],
+                            out=rollouts.policy_outputs(step, group_slice))
+                    group_envs.step_async(action)
+
+            with torch.inference_mode(), autocast():
+                next_value = get_value(
+                    rollouts.obs[-1], rollouts.recurrent_hidden_states[-1],
+                    rollouts.masks[-1]).detach()
+
+            if use_gail:
+                if j >= 10:
+                    for group_envs, _ in env_groups:
+                        group_envs.venv.eval()
+
+                gail_epoch = args.gail_epoch
+                if j < 10:
+                    gail_epoch = 100  # Warm up
+                for _ in range(gail_epoch):
+                    discr.update(gail_train_loader, rollouts, obfilt)
+
+                for step in range(num_steps):
+                    rollouts.rewards[step] = discr.predict_reward(
+                        rollouts.obs[step], rollouts.actions[step], args.gamma,
+                        rollouts.masks[step])
+
+            rollouts.compute_returns(next_value, args.use_gae, args.gamma,
+                                     args.gae_lambda,
+                                     args.use_proper_time_limits)
+
+            # The update is not overlapped with the next rollout, whose
+            # first actions need the new weights. Only the reward log write,
+            # which reads host data alone, is moved ahead of the
+            # save/log/eval branches.
+            value_loss, action_loss, dist_entropy = agent.update(rollouts)
+
+            rollouts.after_update()
+
+            # ADDED:
+            if j % log_mean_interval == 0 and len(episode_rewards) > 1:
+                rewards = episode_rewards.values()
+                np.float32([np.mean(rewards),
+                            np.amax(rewards)]).tofile(log_mean_f)
+                log_mean_f.flush()
+
+            # save for every interval-th episode or for the last epoch
+            if (j % save_interval == 0 or j == num_updates - 1) and do_save:
+                # Only keep one checkpoint in flight to avoid IO contention
+                if checkpoint_future is not None:
+                    checkpoint_future.result()
+                # Snapshot both objects, training keeps updating them while the
+                # background thread pickles and writes the copies
+                checkpoint = copy.deepcopy(
+                    [actor_critic, getattr(vec_norm, 'obs_rms', None)])
+                checkpoint_future = checkpoint_executor.submit(
+                    torch.save, checkpoint,
+                    os.path.join(save_path, args.env_name + ".pt"),
+                    _use_new_zipfile_serialization=False)
+
+            if j % log_interval == 0 and len(episode_rewards) > 1:
+                total_num_steps = (j + 1) * args.num_processes * num_steps
+                end = time.time()
+                rewards = episode_rewards.values()
+                # The losses stay on the device until here, one sync per log
+                dist_entropy, value_loss, action_loss = torch.stack(
+                    [dist_entropy, value_loss, action_loss]).tolist()
+                print(
+                    "Updates {}, num timesteps {}, FPS {} \n Last {} training episodes: mean/median reward {:.1f}/{:.1f}, min/max reward {:.1f}/{:.1f}\n"
+                    .format(j, total_num_steps,
+                            int(total_num_steps / (end - start)),
+                            len(rewards), np.mean(rewards),
+                            np.median(rewards), np.min(rewards),
+                            np.max(rewards), dist_entropy, value_loss,
+                            action_loss))
+            
+            if (eval_interval is not None and len(episode_rewards) > 1
+                    and j % eval_interval == 0):
+                evaluate(actor_critic, vec_norm.obs_rms, args.env_name,
+                         args.seed, args.num_processes, eval_log_dir, device)
+    finally:
+        # Also unlinks the shared memory of the shmem envs
+        for group_envs, _ in env_groups:
+            group_envs.close()
+
+    checkpoint_executor.shutdown()
+    if checkpoint_future is not None:
+        checkpoint_future.result()
+
+    log_mean_f.close()
 
 
 if __name__ == "__main__":
@@ -9,7 +9,6 @@ FilePath: /origin/home/zheyu/Desktop/Deep_Learning/together/IAM-Reproduce/plot_r
 from stable_baselines3.common import results_plotter
 import matplotlib.pyplot as plt
 import numpy as np
-import pickle
 
 # #COMMENT
 # Plot all reward monitors of processes using SB3
@@ -20,14 +19,14 @@ import pickle
 
 #COMMENT 
 # Plot manually stored mean rewards
-with open('./log_w/mean_rewards_GRU.txt', 'rb') as f:
-    mean_episode_rewards_GRU = pickle.load(f)
-with open('./log_w/mean_rewards_IAM.txt', 'rb') as f:
-    mean_episode_rewards_IAM = pickle.load(f)
-with open('./log_w/mean_rewards_FNN8.txt', 'rb') as f:
-    mean_episode_rewards_FNN8 = pickle.load(f)
-with open('./log_w/mean_rewards_FNN1.txt', 'rb') as f:
-    mean_episode_rewards_FNN1 = pickle.load(f)
+mean_episode_rewards_GRU = np.fromfile(
+    './log_w/mean_rewards_GRU.txt', dtype=np.float32).reshape(-1, 2)[:, 0]
+mean_episode_rewards_IAM = np.fromfile(
+    './log_w/mean_rewards_IAM.txt', dtype=np.float32).reshape(-1, 2)[:, 0]
+mean_episode_rewards_FNN8 = np.fromfile(
+    './log_w/mean_rewards_FNN8.txt', dtype=np.float32).reshape(-1, 2)[:, 0]
+mean_episode_rewards_FNN1 = np.fromfile(
+    './log_w/mean_rewards_FNN1.txt', dtype=np.float32).reshape(-1, 2)[:, 0]
 
 mean_episode_rewards_GRU = np.array(mean_episode_rewards_GRU)
 mean_episode_rewards_IAM = np.array(mean_episode_rewards_IAM)
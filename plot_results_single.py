@@ -9,7 +9,6 @@ FilePath: /origin/home/zheyu/Desktop/Deep_Learning/together/IAM-Reproduce/plot_r
 from stable_baselines3.common import results_plotter
 import matplotlib.pyplot as plt
 import numpy as np
-import pickle
 
 # #COMMENT
 # Plot all reward monitors of processes using SB3
@@ -20,8 +19,8 @@ import pickle
 
 #COMMENT 
 # Plot manually stored mean rewards
-with open('./log_fa/mean_rewards_IAM.txt', 'rb') as f:
-    mean_episode_rewards = pickle.load(f)
+mean_episode_rewards = np.fromfile(
+    './log_fa/mean_rewards_IAM.txt', dtype=np.float32).reshape(-1, 2)[:, 0]
 
 mean_episode_rewards = np.array(mean_episode_rewards)
 # timesteps = HERE * mean_log_interval * processes * num_step